@@ -1,4 +1,9 @@
 #! /usr/bin/env python
 # -*- coding: utf-8 -*-
 
-from .downchan import main
+
+def main():
+    # Imported here so submodules (i.e. downchan.lock) can be used without
+    # the runtime dependencies of the downloader
+    from .downchan import main as _main
+    return _main()
@@ -1,14 +1,28 @@
 # Used to parse thread urls
+import errno
 import logging
 import os
 import re
 from common import THREADS_DIRECTORY, STATIC_DIRECTORY, STATIC_NAMESPACES
+from lock import FileLock
 
 RE_BOARD_THREAD_URL = r"http://boards.4chan.org/(\w+)/res/(\d+)"
 
 
+def _ignore_exists(func, *args):
+    """ Call func(*args), ignoring it if the target was already created.
+    Another downchan process may be initializing the same thread.
+    """
+    try:
+        func(*args)
+    except OSError as err:
+        if err.errno != errno.EEXIST:
+            raise
+
+
 class FourChanThread():
     TOKEN_FNAME = '.downchan.thread.token'
+    LOCK_FNAME = '.downchan.thread.lock'
 
     def __init__(self, board, thread_no, subdir=None, slug=None):
         self._board = board
@@ -21,13 +35,17 @@ class FourChanThread():
         if not os.path.isdir(self._path):
             logging.info("%s: Making directory '%s'", self._thread_id,
                          self._path)
-            os.makedirs(self._path)
+            _ignore_exists(os.makedirs, self._path)
         thread_file = self._token_file(self._path)
         if not os.path.isfile(thread_file):
             logging.info("%s: Writing thread_id file '%s'", self._thread_id,
                          thread_file)
-            with open(thread_file, 'w') as fout:
+            # Written aside and renamed, so other processes listing threads
+            # never read a partial file
+            tmp_file = "%s.%s.tmp" % (thread_file, os.getpid())
+            with open(tmp_file, 'w') as fout:
                 print >> fout, self._thread_id
+            os.rename(tmp_file, thread_file)
         for namespace in STATIC_NAMESPACES:
             static_dir = os.path.join(self._path, namespace)
             if not os.path.exists(static_dir):
@@ -35,10 +53,10 @@ class FourChanThread():
                 if not os.path.isdir(source):
                     logging.info("Creating global static directory: '%s'",
                                  source)
-                    os.makedirs(source)
+                    _ignore_exists(os.makedirs, source)
                 logging.info("Linking static dir: %s -> %s", source,
                              static_dir)
-                os.symlink(source, static_dir)
+                _ignore_exists(os.symlink, source, static_dir)
 
     @property
     def path(self):
@@ -52,6 +70,10 @@ class FourChanThread():
     def thread_no(self):
         return self._thread_no
 
+    def lock(self):
+        """ Lock used by workers to claim this thread for updating """
+        return FileLock(os.path.join(self._path, self.LOCK_FNAME))
+
     def url(self):
         return ("http://boards.4chan.org/{0.board}/thread/"
                 "{0.thread_no}".format(self))
@@ -2,8 +2,15 @@ import logging
 import cPickle
 import os
 
+from .lock import FileLock, LockError
+
 _LOG = logging.getLogger('downchan.data')
 
+# The save lock is only held for a moment, so a lock this old was left behind
+# by a crashed worker
+SAVE_LOCK_STALE_SECONDS = 30
+SAVE_LOCK_TIMEOUT = 2 * SAVE_LOCK_STALE_SECONDS
+
 
 def _mkparent_and_open(fname, mode=None):
     dirname = os.path.dirname(fname)
@@ -42,6 +49,11 @@ class DataStorage():
     If the file does not exist, the second argument will be assigned as
     default.
 
+    Saving is done while holding a `FileLock` on '<path>.lock', so several
+    processes can share the same file. Subclasses can override `_merge` to
+    combine their data with what other processes saved meanwhile instead of
+    overwriting it.
+
     WARNING: data is persisted with the `cPickle` module, so some types cannot
     be persisted. Refer to the
     `pickle docs <http://docs.python.org/2/library/pickle.html>`_ for further
@@ -78,24 +90,58 @@ class DataStorage():
 
     def _load(self):
         ''' Load data from file '''
-        if not os.path.isfile(self._path):
+        return self._load_from(self._path)
+
+    def _load_from(self, path):
+        if not os.path.isfile(path):
             _LOG.info("'%s' is not a valid file. Returning default",
-                      self._path)
+                      path)
             return self._default
 
         try:
-            _LOG.info("Unpickling data from '%s'", self._path)
-            with open(self._path) as fin:
+            _LOG.info("Unpickling data from '%s'", path)
+            with open(path) as fin:
                 return cPickle.load(fin)
-        except (IOError, ValueError):
-            _LOG.exception("Problems loading file '%s'", self._path)
+        except (IOError, ValueError, EOFError, cPickle.UnpicklingError):
+            _LOG.exception("Problems loading file '%s'", path)
             return None
 
+    def _merge(self, stored):
+        '''
+        Combine current data with the one currently stored on disk, which may
+        have been saved by another process. Default is to overwrite it.
+
+        Implementations must update `self._data` in place, as callers keep
+        references to it.
+        '''
+
     def save(self):
         """ Save the data to disk """
         if self._data is None:
             return
         _LOG.info("Saving DataStorage to '%s'...", self._path)
-        with _mkparent_and_open(self._path) as fout:
-            cPickle.dump(self._data, fout)
+        lock = FileLock(self._path + '.lock',
+                        stale_seconds=SAVE_LOCK_STALE_SECONDS)
+        try:
+            lock.acquire(timeout=SAVE_LOCK_TIMEOUT)
+        except LockError:
+            _LOG.exception("Could not lock '%s'. Not saving", self._path)
+            return
+        try:
+            stored = self._load_from(self._path)
+            if stored is not None:
+                self._merge(stored)
+            # Write to a temp file and rename, so readers never see a partial
+            # pickle
+            tmp_path = "%s.%s.tmp" % (self._path, os.getpid())
+            try:
+                with _mkparent_and_open(tmp_path, 'wb') as fout:
+                    cPickle.dump(self._data, fout)
+                os.rename(tmp_path, self._path)
+            except Exception:
+                if os.path.exists(tmp_path):
+                    os.unlink(tmp_path)
+                raise
+        finally:
+            lock.release()
         _LOG.info("Saved.")
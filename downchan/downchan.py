@@ -10,6 +10,8 @@ Each thread has its own folder under MAIN_DIRECTORY/threads.
 Example directory structure for thread an.1615086
 
 threads/an.1615086
+|-.downchan.thread.lock: Present while a downchan process is updating the
+|         thread. Other processes skip it meanwhile
 |-thread: This file contains the thread id (an.1615086)
 |         This allows the folder to be renamed to something more human readable
 |         (i.e. cute-animals) and still knowing where the thread came from
@@ -21,9 +23,15 @@ threads/an.1615086
 |-css: subfolder for css
 \-js: subfolder for js
 
+Several downchan processes (even on different machines sharing
+MAIN_DIRECTORY over NFS) can update the archive at the same time: each thread
+is claimed by a single process through a lock file. Static files, shared by
+all threads, are claimed one by one the same way.
+
 '''
 import collections
 import datetime
+import errno
 import logging
 import os
 import requests
@@ -35,11 +43,15 @@ from argparse import ArgumentParser
 from BeautifulSoup import BeautifulSoup
 
 from .data import DataStorage
-from .common import MAIN_DIRECTORY, THREADS_DIRECTORY
+from .common import MAIN_DIRECTORY, THREADS_DIRECTORY, STATIC_NAMESPACES
 from .chanthread import FourChanThread
+from .lock import FileLock, LockLost
 
 NOT_FOUND_FILE = os.path.join(MAIN_DIRECTORY, "404")
 
+# os.link errors from filesystems without hard links (i.e. CIFS, some FUSE)
+_NO_LINK_ERRNOS = (errno.EPERM, errno.ENOTSUP, errno.EOPNOTSUPP, errno.ENOSYS)
+
 
 class NotFound(DataStorage):
 
@@ -48,6 +60,9 @@ class NotFound(DataStorage):
     def __init__(self, path):
         DataStorage.__init__(self, path, set())
 
+    def _merge(self, stored):
+        self._data |= stored
+
 
 def _get_arg_parser():
     parser = ArgumentParser()
@@ -134,10 +149,20 @@ def _nice_size(size):
     return "%.2f %sb" % (size, UNITS[index])
 
 
-def _download(url, dest):
+def _keep_alive(*locks):
+    """ Refresh the given locks, raising LockLost if any of them is gone """
+    for lock in locks:
+        if lock is not None and not lock.refresh():
+            raise LockLost("Lost lock '%s'" % lock.path)
+
+
+def _download(url, dest, thread_lock=None, shared=False):
     """ Download the given url to the given destination.
     With progress line and everything.
     Destination file will be created only if download was completed.
+    `thread_lock` is kept alive while downloading. `shared` destinations (the
+    static files, which all threads link to) are also claimed through their
+    own lock, as workers updating other threads may want them too.
     """
     parent = os.path.dirname(dest)
     if not os.path.isdir(parent):
@@ -147,10 +172,38 @@ def _download(url, dest):
         logging.info("'%s' is already downloaded", dest)
         return
 
+    if not shared:
+        # Only the worker holding the thread lock writes here
+        _do_download(url, dest, lambda: _keep_alive(thread_lock))
+        return
+
+    lock = FileLock(dest + '.lock')
+    if not lock.acquire(blocking=False):
+        logging.info("'%s' is being downloaded by another worker", dest)
+        return
+    try:
+        # Someone may have finished it before we got the lock
+        if os.path.isfile(dest):
+            logging.info("'%s' is already downloaded", dest)
+            return
+        _do_download(url, dest, lambda: _keep_alive(lock, thread_lock))
+    except LockLost:
+        if thread_lock is not None and not thread_lock.locked:
+            raise
+        # Only this file was taken over, the rest of the thread is still ours
+        logging.warning("'%s' was taken over by another worker", dest)
+    finally:
+        lock.release()
+
+
+def _do_download(url, dest, keep_alive):
     response = requests.get(_norm_url(url), stream=True)
     total_length = response.headers.get('content-length')
 
-    with tempfile.NamedTemporaryFile("wb") as fout:
+    # Temp file lives next to dest so it can be linked there atomically
+    with tempfile.NamedTemporaryFile("wb", dir=os.path.dirname(dest),
+                                     prefix='.downchan.',
+                                     suffix='.tmp') as fout:
         if total_length is None:  # no content length header
             logging.info('No size received from response.')
             fout.write(response.content)
@@ -165,6 +218,7 @@ def _download(url, dest):
                 fout.write(data)
                 now = time.time()
                 if now - last_show > 0.1:
+                    keep_alive()
                     progress_data.append((time.time(), dl))
                     progress_data = progress_data[-20:]
                     if len(progress_data) > 1:
@@ -197,12 +251,38 @@ def _download(url, dest):
             ))
             sys.stdout.flush()
 
-        # Sync the temporal file buffer before copying
+        # Sync the temporal file buffer before linking
         fout.flush()
         os.fsync(fout)
-        logging.info("Copying temp file to final destination")
-        shutil.copy(fout.name, dest)
-        os.chmod(dest, 0664)  # Make file readable for apache (default is 0600)
+        keep_alive()
+        os.chmod(fout.name, 0664)  # Make readable for apache (default is 0600)
+        _publish(fout.name, dest)
+
+
+def _publish(src, dest):
+    """ Make the finished download `src` available at `dest` atomically,
+    without removing `src`.
+    """
+    logging.info("Linking temp file to final destination")
+    try:
+        os.link(src, dest)
+    except OSError as err:
+        if err.errno == errno.EEXIST:
+            logging.info("'%s' was downloaded by another worker meanwhile",
+                         dest)
+        elif err.errno in _NO_LINK_ERRNOS:
+            # We hold the claim on dest, so copying aside and renaming is safe
+            logging.info("No hard links supported. Copying temp file instead")
+            tmp_dest = "%s.%s.tmp" % (dest, os.getpid())
+            try:
+                shutil.copy(src, tmp_dest)
+                os.rename(tmp_dest, dest)
+            except Exception:
+                if os.path.exists(tmp_dest):
+                    os.unlink(tmp_dest)
+                raise
+        else:
+            raise
 
 
 def _embed(filename, alt=None):
@@ -259,7 +339,7 @@ def update_thread_file(thread):
     return data
 
 
-def download_thread(thread):
+def download_thread(thread, lock=None):
     label = os.path.basename(thread.path)
 
     data = update_thread_file(thread)
@@ -278,16 +358,18 @@ def download_thread(thread):
         for url, outfile in downloads:
             fulldest = os.path.join(thread.path, outfile)
             if not os.path.isfile(fulldest):
-                to_download.append((url, fulldest))
+                to_download.append((url, fulldest,
+                                    namespace in STATIC_NAMESPACES))
                 namespaces[namespace] += 1
     logging.info("%s downloads: %s were already downloaded, %s are missing "
                  "(%s)", total_downloads, total_downloads - len(to_download),
                  len(to_download), dict(namespaces))
 
-    for i, (url, outfile) in enumerate(to_download):
+    for i, (url, outfile, shared) in enumerate(to_download):
         logging.info("%s: Downloads %s/%s: '%s'", label, i + 1,
                      len(to_download), url)
-        _download(url, outfile)
+        _keep_alive(lock)  # Long updates should not look abandoned
+        _download(url, outfile, lock, shared)
 
 
 def main():
@@ -331,9 +413,21 @@ def main():
             logging.info("I have %s/%s threads to update", len(live_threads),
                          len(threads_to_update))
             for thread in live_threads:
-                if update_original(thread) == 404:
-                    not_found.add((thread.board, thread.thread_no))
-                download_thread(thread)
+                lock = thread.lock()
+                if not lock.acquire(blocking=False):
+                    logging.info("%s: being updated by another worker. "
+                                 "Skipping", os.path.basename(thread.path))
+                    continue
+                try:
+                    if update_original(thread) == 404:
+                        not_found.add((thread.board, thread.thread_no))
+                    download_thread(thread, lock)
+                except LockLost:
+                    logging.warning("%s: lock was taken by another worker. "
+                                    "Leaving the thread to it",
+                                    os.path.basename(thread.path))
+                finally:
+                    lock.release()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,252 @@
+import binascii
+import errno
+import logging
+import os
+import socket
+import time
+
+_LOG = logging.getLogger('downchan.lock')
+
+# Errors meaning the lock file is gone. Over NFS, a file renamed or removed by
+# another host may give ESTALE instead of ENOENT
+_GONE_ERRNOS = (errno.ENOENT, errno.ESTALE)
+
+# Locks not refreshed in this many seconds are considered abandoned by a dead
+# worker
+STALE_SECONDS = 60 * 60
+
+
+class LockError(Exception):
+    pass
+
+
+class LockLost(LockError):
+
+    """ Raised by lock users when a lock they held was taken by someone else
+    """
+
+
+class FileLock():
+
+    """
+    Cross-process lock backed by a file created with O_CREAT | O_EXCL.
+
+    Exclusive creation is atomic on local filesystems and on NFSv3+, so it
+    can be used by several processes (or machines sharing the archive) to
+    claim a piece of work.
+
+    Sample usage:
+
+    >>> with FileLock('/path/to/file.lock'):
+    >>>     do_exclusive_work()
+
+    Or, for claiming work that someone else may already be doing:
+
+    >>> lock = FileLock('/path/to/file.lock')
+    >>> if lock.acquire(blocking=False):
+    >>>     try:
+    >>>         do_exclusive_work()
+    >>>     finally:
+    >>>         lock.release()
+
+    The lock file holds an owner token: "<hostname> <pid> <nonce>". A lock is
+    considered stale, and broken, if its owner was on this host and is no
+    longer running, or if it has not been refreshed in `stale_seconds`.
+    Long running owners must call `refresh` periodically.
+
+    Breaking and releasing never remove a lock file blindly: the file is
+    first renamed to a private name and only removed if it is still the one
+    that was checked. Otherwise it is put back.
+
+    """
+
+    def __init__(self, path, stale_seconds=STALE_SECONDS):
+        """
+
+        Create a new (not acquired) lock
+
+        @param path: lock file path
+        @param stale_seconds: age after which an existing lock is broken
+
+        """
+        self._path = path
+        self._stale_seconds = stale_seconds
+        self._token = None
+        self._refreshed = 0
+
+    @property
+    def path(self):
+        return self._path
+
+    @property
+    def locked(self):
+        return self._token is not None
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, _type, _value, _traceback):
+        self.release()
+
+    def acquire(self, blocking=True, timeout=None, poll=0.5):
+        """ Acquire the lock.
+
+        Returns True if the lock was acquired. If `blocking` is False, returns
+        False right away if someone else holds it. Otherwise waits for it,
+        raising LockError if `timeout` seconds go by.
+        """
+        start = time.time()
+        while not self._try_acquire():
+            if not blocking:
+                return False
+            if timeout is not None and time.time() - start > timeout:
+                raise LockError("Timeout acquiring lock '%s'" % self._path)
+            time.sleep(poll)
+        return True
+
+    def release(self):
+        """ Release the lock, if we still own it """
+        if not self.locked:
+            return
+        token, self._token = self._token, None
+        read = self._read()
+        if read is None or read[0][1] != token:
+            _LOG.warning("Lock '%s' was taken by someone else. Not removing "
+                         "it", self._path)
+            return
+        if not self._remove_if(read[0]):
+            _LOG.warning("Lock '%s' changed while releasing it", self._path)
+
+    def refresh(self):
+        """ Touch the lock file so it is not seen as stale.
+
+        It is cheap to call often: the file is only touched every
+        `stale_seconds / 10`. Returns False if the lock is no longer ours, in
+        which case the caller should stop the work it was protecting.
+        """
+        if not self.locked:
+            return False
+        if time.time() - self._refreshed < self._stale_seconds / 10.:
+            return True
+        read = self._read()
+        if read is None or read[0][1] != self._token:
+            _LOG.warning("Lost lock '%s'", self._path)
+            self._token = None
+            return False
+        try:
+            os.utime(self._path, None)
+        except OSError:
+            _LOG.exception("Problems refreshing lock '%s'", self._path)
+            self._token = None
+            return False
+        self._refreshed = time.time()
+        return True
+
+    def _new_token(self):
+        return "%s %s %s" % (socket.gethostname(), os.getpid(), _nonce())
+
+    def _try_acquire(self):
+        if self.locked:
+            return True
+        parent = os.path.dirname(self._path)
+        if parent and not os.path.isdir(parent):
+            try:
+                os.makedirs(parent)
+            except OSError:
+                pass  # Created by someone else meanwhile
+        token = self._new_token()
+        try:
+            fd = os.open(self._path, os.O_CREAT | os.O_EXCL | os.O_WRONLY,
+                         0o644)
+        except OSError as err:
+            if err.errno != errno.EEXIST:
+                raise
+            if self._break_if_stale():
+                return self._try_acquire()
+            return False
+        try:
+            os.write(fd, token.encode('ascii'))
+        finally:
+            os.close(fd)
+        self._token = token
+        self._refreshed = time.time()
+        return True
+
+    def _read(self, path=None):
+        """ Returns ((inode, token), mtime) of the lock file, or None if
+        missing
+        """
+        path = path or self._path
+        try:
+            stat = os.stat(path)
+            with open(path) as fin:
+                token = fin.read().strip()
+        except (IOError, OSError) as err:
+            if err.errno not in _GONE_ERRNOS:
+                raise
+            return None
+        return (stat.st_ino, token), stat.st_mtime
+
+    def _is_stale(self, token, mtime):
+        if time.time() - mtime > self._stale_seconds:
+            return True
+        owner = token.split()
+        if (len(owner) >= 2 and owner[0] == socket.gethostname() and
+                owner[1].isdigit()):
+            return not _pid_alive(int(owner[1]))
+        return False
+
+    def _break_if_stale(self):
+        """ Remove the lock file if its owner is gone. Returns True if the
+        lock should be retried.
+        """
+        read = self._read()
+        if read is None:
+            return True  # Released meanwhile
+        snapshot, mtime = read
+        if not self._is_stale(snapshot[1], mtime):
+            return False
+        _LOG.warning("Breaking stale lock '%s' (owner: %s)", self._path,
+                     snapshot[1])
+        return self._remove_if(snapshot)
+
+    def _remove_if(self, snapshot):
+        """ Atomically remove the lock file if it is still the one described
+        by `snapshot` (inode, token). Returns True if it was removed or was
+        already missing.
+        """
+        private = "%s.stale.%s.%s.%s" % (self._path, socket.gethostname(),
+                                         os.getpid(), _nonce())
+        try:
+            os.rename(self._path, private)
+        except OSError as err:
+            if err.errno not in _GONE_ERRNOS:
+                raise
+            return True
+        read = self._read(private)
+        if read is not None and read[0] == snapshot:
+            os.unlink(private)
+            return True
+        # We grabbed a fresh lock from someone else: put it back
+        try:
+            os.link(private, self._path)
+        except OSError as err:
+            if err.errno != errno.EEXIST:
+                raise
+            _LOG.warning("Could not restore lock '%s', a new one was made",
+                         self._path)
+        os.unlink(private)
+        return False
+
+
+def _nonce():
+    return binascii.hexlify(os.urandom(8)).decode('ascii')
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError as err:
+        return err.errno == errno.EPERM
+    return True
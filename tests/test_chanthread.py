@@ -0,0 +1,64 @@
+import os
+import shutil
+import tempfile
+import types
+import unittest
+
+from downchan import chanthread
+from downchan.chanthread import FourChanThread
+
+
+class _NothingExistsPath(object):
+
+    """ os.path replacement for a worker which checked for files just before
+    another one created them
+    """
+
+    def __getattr__(self, name):
+        return getattr(os.path, name)
+
+    def isdir(self, _path):
+        return False
+
+    isfile = exists = isdir
+
+
+class FourChanThreadInitTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.patch(chanthread, 'THREADS_DIRECTORY',
+                   os.path.join(self.tmpdir, 'threads'))
+        self.patch(chanthread, 'STATIC_DIRECTORY',
+                   os.path.join(self.tmpdir, 'static'))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def patch(self, obj, name, value):
+        self.addCleanup(setattr, obj, name, getattr(obj, name))
+        setattr(obj, name, value)
+
+    def test_init(self):
+        thread = FourChanThread('a', 1)
+        thread.init()
+        self.assertEqual([(t.board, t.thread_no)
+                          for t in FourChanThread.all()], [('a', 1)])
+        self.assertTrue(os.path.islink(os.path.join(thread.path, 'css')))
+
+    def test_concurrent_init(self):
+        FourChanThread('a', 1).init()
+        late_os = types.ModuleType('os')
+        late_os.__dict__.update(os.__dict__)
+        late_os.path = _NothingExistsPath()
+        self.patch(chanthread, 'os', late_os)
+        FourChanThread('a', 1).init()  # Must not fail with EEXIST
+        self.patch(chanthread, 'os', os)
+        self.assertEqual([(t.board, t.thread_no)
+                          for t in FourChanThread.all()], [('a', 1)])
+        self.assertEqual(sorted(os.listdir(FourChanThread('a', 1).path)),
+                         ['.downchan.thread.token', 'css', 'js'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,73 @@
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+from downchan.data import DataStorage, SAVE_LOCK_STALE_SECONDS
+
+
+class _Unpicklable(object):
+
+    def __reduce__(self):
+        raise TypeError("Cannot pickle this")
+
+
+class DataStorageTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'data')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_saves_with_block(self):
+        with DataStorage(self.path, {}) as data:
+            data['key'] = 'value'
+        self.assertEqual(DataStorage(self.path, {}).data, {'key': 'value'})
+
+    def test_data_reference_survives_saves(self):
+        storage = DataStorage(self.path, {})
+        data = storage.data
+        data['first'] = 1
+        storage.save()
+        data['second'] = 2
+        storage.save()
+        self.assertEqual(DataStorage(self.path, {}).data,
+                         {'first': 1, 'second': 2})
+
+    def test_overwrites_by_default(self):
+        first = DataStorage(self.path, {})
+        second = DataStorage(self.path, {})
+        first.data['first'] = 1
+        first.save()
+        second.data['second'] = 2
+        second.save()
+        self.assertEqual(DataStorage(self.path, {}).data, {'second': 2})
+
+    def test_no_leftovers(self):
+        with DataStorage(self.path, {}) as data:
+            data['key'] = 'value'
+        self.assertEqual(os.listdir(self.tmpdir), ['data'])
+
+    def test_failed_save_removes_temp_file(self):
+        storage = DataStorage(self.path, {})
+        storage.data['key'] = _Unpicklable()
+        self.assertRaises(Exception, storage.save)
+        self.assertEqual(os.listdir(self.tmpdir), [])
+
+    def test_breaks_abandoned_save_lock(self):
+        lock_file = self.path + '.lock'
+        with open(lock_file, 'w') as fout:
+            fout.write("otherhost 1 crashed")
+        old = time.time() - 2 * SAVE_LOCK_STALE_SECONDS
+        os.utime(lock_file, (old, old))
+        with DataStorage(self.path, {}) as data:
+            data['key'] = 'value'
+        self.assertEqual(DataStorage(self.path, {}).data, {'key': 'value'})
+        self.assertFalse(os.path.exists(lock_file))
+
+
+if __name__ == '__main__':
+    unittest.main()
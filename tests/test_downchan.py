@@ -0,0 +1,239 @@
+import errno
+import os
+import shutil
+import socket
+import sys
+import tempfile
+import unittest
+
+from downchan import chanthread
+from downchan import downchan
+from downchan.chanthread import FourChanThread
+from downchan.lock import FileLock, LockLost
+
+
+def _read(path):
+    with open(path) as fin:
+        return fin.read()
+
+
+def _write(path, content):
+    with open(path, 'w') as fout:
+        fout.write(content)
+
+
+def _live_token():
+    """ Lock token of a live worker on this host other than ourselves """
+    return "%s %s other" % (socket.gethostname(), os.getpid())
+
+
+class _FakeResponse(object):
+
+    def __init__(self, content, on_read=None):
+        self.content = content
+        self.status_code = 200
+        self.headers = {'content-length': str(len(content))}
+        self._on_read = on_read
+
+    def iter_content(self):
+        if self._on_read:
+            self._on_read()
+        yield self.content
+
+
+class _DownchanTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.requested = []
+        self.response = _FakeResponse('data')
+        self.patch(downchan.requests, 'get', self._get)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def patch(self, obj, name, value):
+        self.addCleanup(setattr, obj, name, getattr(obj, name))
+        setattr(obj, name, value)
+
+    def _get(self, url, **_kwargs):
+        self.requested.append(url)
+        return self.response
+
+    def listdir(self, path=None):
+        return sorted(os.listdir(path or self.tmpdir))
+
+
+class NotFoundTest(_DownchanTestCase):
+
+    def setUp(self):
+        _DownchanTestCase.setUp(self)
+        self.path = os.path.join(self.tmpdir, '404')
+
+    def test_data_reference_survives_saves(self):
+        storage = downchan.NotFound(self.path)
+        data = storage.data
+        data.add(1)
+        storage.save()
+        data.add(2)
+        storage.save()
+        self.assertEqual(downchan.NotFound(self.path).data, set([1, 2]))
+
+    def test_merges_with_other_workers(self):
+        first = downchan.NotFound(self.path)
+        second = downchan.NotFound(self.path)
+        with first as data:
+            data.add(1)
+        with second as data:
+            data.add(2)
+        self.assertEqual(downchan.NotFound(self.path).data, set([1, 2]))
+        self.assertEqual(second.data, set([1, 2]))
+
+
+class DownloadTest(_DownchanTestCase):
+
+    def setUp(self):
+        _DownchanTestCase.setUp(self)
+        self.dest = os.path.join(self.tmpdir, 'file.jpg')
+        self.thread_lock = FileLock(os.path.join(self.tmpdir, 'thread.lock'),
+                                    stale_seconds=0)
+        self.thread_lock.acquire()
+
+    def tearDown(self):
+        self.thread_lock.release()
+        _DownchanTestCase.tearDown(self)
+
+    def test_download(self):
+        downchan._download('example.com/file.jpg', self.dest,
+                           self.thread_lock)
+        self.assertEqual(_read(self.dest), 'data')
+        self.assertEqual(self.listdir(), ['file.jpg', 'thread.lock'])
+
+    def test_already_downloaded(self):
+        _write(self.dest, 'old')
+        downchan._download('example.com/file.jpg', self.dest)
+        self.assertEqual(self.requested, [])
+        self.assertEqual(_read(self.dest), 'old')
+
+    def test_own_files_take_no_lock(self):
+        def check_no_lock():
+            self.assertFalse(os.path.exists(self.dest + '.lock'))
+        self.response = _FakeResponse('data', on_read=check_no_lock)
+        downchan._download('example.com/file.jpg', self.dest,
+                           self.thread_lock)
+        self.assertEqual(_read(self.dest), 'data')
+
+    def test_shared_file_is_locked_while_downloading(self):
+        def check_lock():
+            self.assertTrue(os.path.exists(self.dest + '.lock'))
+        self.response = _FakeResponse('data', on_read=check_lock)
+        downchan._download('example.com/file.jpg', self.dest,
+                           self.thread_lock, shared=True)
+        self.assertEqual(_read(self.dest), 'data')
+        self.assertFalse(os.path.exists(self.dest + '.lock'))
+
+    def test_skips_shared_file_claimed_by_other_worker(self):
+        _write(self.dest + '.lock', _live_token())
+        downchan._download('example.com/file.jpg', self.dest,
+                           self.thread_lock, shared=True)
+        self.assertEqual(self.requested, [])
+        self.assertFalse(os.path.exists(self.dest))
+        self.assertEqual(_read(self.dest + '.lock'), _live_token())
+
+    def test_finished_by_other_worker_meanwhile(self):
+        self.response = _FakeResponse(
+            'data', on_read=lambda: _write(self.dest, 'other'))
+        downchan._download('example.com/file.jpg', self.dest,
+                           self.thread_lock)
+        self.assertEqual(_read(self.dest), 'other')
+        self.assertEqual(self.listdir(), ['file.jpg', 'thread.lock'])
+
+    def test_no_hard_link_support(self):
+        def no_link(src, dest):
+            raise OSError(errno.EPERM, "Operation not permitted")
+        self.patch(os, 'link', no_link)
+        downchan._download('example.com/file.jpg', self.dest,
+                           self.thread_lock)
+        self.assertEqual(_read(self.dest), 'data')
+        self.assertEqual(self.listdir(), ['file.jpg', 'thread.lock'])
+
+    def test_thread_lock_lost(self):
+        self.response = _FakeResponse(
+            'data', on_read=lambda: _write(self.thread_lock.path, 'other'))
+        self.assertRaises(LockLost, downchan._download,
+                          'example.com/file.jpg', self.dest, self.thread_lock)
+        self.assertFalse(os.path.exists(self.dest))
+        self.assertEqual(self.listdir(), ['thread.lock'])
+
+    def test_shared_file_lock_lost(self):
+        self.patch(downchan, 'FileLock',
+                   lambda path: FileLock(path, stale_seconds=0))
+        self.response = _FakeResponse(
+            'data', on_read=lambda: _write(self.dest + '.lock', 'other'))
+        downchan._download('example.com/file.jpg', self.dest,
+                           self.thread_lock, shared=True)
+        self.assertTrue(self.thread_lock.locked)
+        self.assertFalse(os.path.exists(self.dest))
+        # The other worker's lock is left alone
+        self.assertEqual(_read(self.dest + '.lock'), 'other')
+
+
+class MainTest(_DownchanTestCase):
+
+    def setUp(self):
+        _DownchanTestCase.setUp(self)
+        threads_dir = os.path.join(self.tmpdir, 'threads')
+        self.patch(downchan, 'THREADS_DIRECTORY', threads_dir)
+        self.patch(chanthread, 'THREADS_DIRECTORY', threads_dir)
+        self.patch(chanthread, 'STATIC_DIRECTORY',
+                   os.path.join(self.tmpdir, 'static'))
+        self.patch(downchan, 'NOT_FOUND_FILE',
+                   os.path.join(self.tmpdir, '404'))
+        self.patch(sys, 'argv', ['downchan', '-u'])
+        self.updated = []
+        self.patch(downchan, 'update_original', self._update_original)
+        self.patch(downchan, 'download_thread', self._download_thread)
+        self.threads = [FourChanThread('a', 1), FourChanThread('a', 2)]
+        for thread in self.threads:
+            thread.init()
+
+    def _update_original(self, thread):
+        return 200
+
+    def _download_thread(self, thread, lock):
+        self.assertTrue(lock.locked)
+        self.updated.append(thread.thread_no)
+
+    def _lock_file(self, thread):
+        return os.path.join(thread.path, FourChanThread.LOCK_FNAME)
+
+    def test_updates_all_threads(self):
+        downchan.main()
+        self.assertEqual(sorted(self.updated), [1, 2])
+        for thread in self.threads:
+            self.assertFalse(os.path.exists(self._lock_file(thread)))
+
+    def test_skips_thread_claimed_by_other_worker(self):
+        _write(self._lock_file(self.threads[0]), _live_token())
+        downchan.main()
+        self.assertEqual(self.updated, [2])
+        self.assertEqual(_read(self._lock_file(self.threads[0])),
+                         _live_token())
+
+    def test_lost_thread_lock_moves_on(self):
+        def download_thread(thread, lock):
+            self.updated.append(thread.thread_no)
+            if len(self.updated) == 1:
+                _write(self._lock_file(thread), _live_token())
+                raise LockLost("Lost lock '%s'" % lock.path)
+        self.patch(downchan, 'download_thread', download_thread)
+        downchan.main()
+        self.assertEqual(len(self.updated), 2)
+        # The lost lock is left to its new owner, ours is released
+        lock_files = [os.path.exists(self._lock_file(thread))
+                      for thread in self.threads]
+        self.assertEqual(sorted(lock_files), [False, True])
+
+
+if __name__ == '__main__':
+    unittest.main()
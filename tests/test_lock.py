@@ -0,0 +1,177 @@
+import errno
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import unittest
+
+from downchan.lock import FileLock, LockError
+
+
+def _write_lock(path, token, age=0):
+    with open(path, 'w') as fout:
+        fout.write(token)
+    if age:
+        mtime = time.time() - age
+        os.utime(path, (mtime, mtime))
+
+
+def _read_token(path):
+    with open(path) as fin:
+        return fin.read().strip()
+
+
+def _dead_pid():
+    proc = subprocess.Popen([sys.executable, '-c', ''])
+    proc.wait()
+    return proc.pid
+
+
+class FileLockTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'test.lock')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_acquire_and_release(self):
+        lock = FileLock(self.path)
+        self.assertTrue(lock.acquire(blocking=False))
+        self.assertTrue(lock.locked)
+        self.assertTrue(os.path.isfile(self.path))
+        lock.release()
+        self.assertFalse(lock.locked)
+        self.assertFalse(os.path.exists(self.path))
+
+    def test_context_manager(self):
+        with FileLock(self.path) as lock:
+            self.assertTrue(lock.locked)
+        self.assertFalse(os.path.exists(self.path))
+
+    def test_non_blocking_contention(self):
+        first = FileLock(self.path)
+        second = FileLock(self.path)
+        self.assertTrue(first.acquire(blocking=False))
+        self.assertFalse(second.acquire(blocking=False))
+        self.assertFalse(second.locked)
+        first.release()
+        self.assertTrue(second.acquire(blocking=False))
+        second.release()
+
+    def test_blocking_timeout(self):
+        first = FileLock(self.path)
+        first.acquire()
+        second = FileLock(self.path)
+        self.assertRaises(LockError, second.acquire, timeout=0.1, poll=0.05)
+        first.release()
+
+    def test_breaks_dead_pid_lock(self):
+        _write_lock(self.path, "%s %s dead" % (socket.gethostname(),
+                                               _dead_pid()))
+        lock = FileLock(self.path)
+        self.assertTrue(lock.acquire(blocking=False))
+        self.assertNotEqual(_read_token(self.path), "dead")
+        lock.release()
+
+    def test_keeps_live_pid_lock(self):
+        _write_lock(self.path, "%s %s alive" % (socket.gethostname(),
+                                                os.getpid()))
+        self.assertFalse(FileLock(self.path).acquire(blocking=False))
+
+    def test_breaks_mtime_stale_lock(self):
+        _write_lock(self.path, "otherhost 1 old", age=120)
+        lock = FileLock(self.path, stale_seconds=60)
+        self.assertTrue(lock.acquire(blocking=False))
+        lock.release()
+
+    def test_keeps_fresh_remote_lock(self):
+        _write_lock(self.path, "otherhost 1 fresh", age=10)
+        lock = FileLock(self.path, stale_seconds=60)
+        self.assertFalse(lock.acquire(blocking=False))
+
+    def test_two_breakers_race(self):
+        _write_lock(self.path, "otherhost 1 old", age=120)
+        first = FileLock(self.path, stale_seconds=60)
+
+        class SlowBreaker(FileLock):
+
+            def _is_stale(self, token, mtime):
+                # Right after we judged the lock stale, the first worker
+                # breaks it and takes it
+                stale = FileLock._is_stale(self, token, mtime)
+                first.acquire(blocking=False)
+                return stale
+
+        second = SlowBreaker(self.path, stale_seconds=60)
+        self.assertFalse(second.acquire(blocking=False))
+        self.assertTrue(first.locked)
+        self.assertFalse(second.locked)
+        # The fresh lock is still there, and no leftovers remain
+        token = _read_token(self.path)
+        self.assertNotEqual(token, "otherhost 1 old")
+        self.assertEqual(os.listdir(self.tmpdir), ['test.lock'])
+        first.release()
+        self.assertEqual(os.listdir(self.tmpdir), [])
+
+    def test_release_keeps_someone_elses_lock(self):
+        first = FileLock(self.path)
+        first.acquire()
+        os.unlink(self.path)  # Broken by someone else...
+        second = FileLock(self.path)
+        second.acquire()  # ... and taken
+        token = _read_token(self.path)
+        first.release()
+        self.assertEqual(_read_token(self.path), token)
+        second.release()
+        self.assertFalse(os.path.exists(self.path))
+
+    def test_refresh(self):
+        lock = FileLock(self.path, stale_seconds=0)
+        lock.acquire()
+        old = time.time() - 120
+        os.utime(self.path, (old, old))
+        self.assertTrue(lock.refresh())
+        self.assertTrue(time.time() - os.path.getmtime(self.path) < 60)
+        lock.release()
+
+    def test_refresh_lost_lock(self):
+        lock = FileLock(self.path, stale_seconds=0)
+        lock.acquire()
+        os.unlink(self.path)
+        self.assertFalse(lock.refresh())
+        self.assertFalse(lock.locked)
+
+    def test_refresh_lock_taken_by_someone_else(self):
+        lock = FileLock(self.path, stale_seconds=0)
+        lock.acquire()
+        _write_lock(self.path, "otherhost 1 other")
+        self.assertFalse(lock.refresh())
+        lock.release()
+        self.assertEqual(_read_token(self.path), "otherhost 1 other")
+
+    def test_stale_nfs_handle_is_a_lost_lock(self):
+        refreshed = FileLock(self.path, stale_seconds=0)
+        refreshed.acquire()
+        released = FileLock(os.path.join(self.tmpdir, 'other.lock'))
+        released.acquire()
+
+        def stale_stat(path):
+            raise OSError(errno.ESTALE, "Stale file handle", path)
+
+        real_stat = os.stat
+        os.stat = stale_stat
+        try:
+            self.assertFalse(refreshed.refresh())
+            released.release()  # Must not raise either
+        finally:
+            os.stat = real_stat
+        self.assertFalse(released.locked)
+
+
+if __name__ == '__main__':
+    unittest.main()